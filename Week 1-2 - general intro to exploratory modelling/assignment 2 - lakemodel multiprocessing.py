@@ -31,30 +31,23 @@ def lake_problem(
 
     Pcrit = brentq(lambda x: x**q / (1 + x**q) - b * x, 0.01, 1.5)
     nvars = len(decisions)
-    X = np.zeros((nvars,))
-    average_daily_P = np.zeros((nvars,))
+    X = np.zeros((nsamples, nvars))
     decisions = np.array(decisions)
-    reliability = 0.0
-
-    for _ in range(nsamples):
-        X[0] = 0.0
-
-        natural_inflows = np.random.lognormal(
-            math.log(mean**2 / math.sqrt(stdev**2 + mean**2)),
-            math.sqrt(math.log(1.0 + stdev**2 / mean**2)),
-            size=nvars,
-        )
-
-        for t in range(1, nvars):
-            X[t] = (
-                (1 - b) * X[t - 1]
-                + X[t - 1] ** q / (1 + X[t - 1] ** q)
-                + decisions[t - 1]
-                + natural_inflows[t - 1]
-            )
-            average_daily_P[t] += X[t] / float(nsamples)
-
-        reliability += np.sum(X < Pcrit) / float(nsamples * nvars)
+
+    # draw the natural inflows for all replications at once, so each time
+    # step updates every replication in a single vectorized operation
+    natural_inflows = np.random.lognormal(
+        math.log(mean**2 / math.sqrt(stdev**2 + mean**2)),
+        math.sqrt(math.log(1.0 + stdev**2 / mean**2)),
+        size=(nsamples, nvars),
+    )
+
+    for t in range(1, nvars):
+        Xq = X[:, t - 1] ** q
+        X[:, t] = (1 - b) * X[:, t - 1] + Xq / (1 + Xq) + decisions[t - 1] + natural_inflows[:, t - 1]
+
+    average_daily_P = np.mean(X, axis=0)
+    reliability = np.sum(X < Pcrit) / float(nsamples * nvars)
 
     max_P = np.max(average_daily_P)
     utility = np.sum(alpha * decisions * np.power(delta, np.arange(nvars)))
@@ -118,15 +118,8 @@ model.uncertainties = [RealParameter('mean', 0.01, 0.05),
 
 # Set levers, one for each time step
 
-model.levers = [RealParameter("c1", -2, 2),
-                RealParameter("c2", -2, 2),
-                RealParameter("r1", 0, 2),
-                RealParameter("r2", 0, 2),
-                RealParameter("w1", 0, 1)]
-def process_p(values):
-    values = np.asarray(values)
-    values = np.mean(values, axis=0)
-    return np.max(values)
+model.levers = [RealParameter(f"l{i}", 0, 0.1) for i in range(100)]
+
 # Specify outcomes
 
 model.outcomes = [ScalarOutcome('max_P'),
@@ -151,7 +144,66 @@ model.constants = [
 # In[6]:
 
 
-from ema_workbench import MultiprocessingEvaluator, ema_logging, perform_experiments
+import hashlib
+import inspect
+import os
+
+import pandas as pd
+from ema_workbench import ema_logging
+from ema_workbench.em_framework.evaluators import Samplers
+
+from batch_evaluator import BatchEvaluator
+from lakemodel_function import lake_problem_batch
+
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def load_or_perform_experiments(model, function, n_scenarios, n_policies, lever_sampling, batch_size=128,
+                                cache_dir="cache"):
+    """Return the results of an earlier identical run from cache_dir, or
+    perform the experiments with a BatchEvaluator running function and store
+    the results there."""
+    # the maps holding the parameters have no stable repr, the parameters do.
+    # The source of the model and of the evaluator is part of the key, so
+    # editing either invalidates the cached results
+    hasher = hashlib.sha1()
+    sources = {inspect.getsourcefile(model.function), inspect.getsourcefile(function),
+               inspect.getsourcefile(BatchEvaluator)}
+    for source in sorted(sources):
+        with open(source, "rb") as f:
+            hasher.update(f.read())
+    hasher.update(repr((model.name, list(model.uncertainties), list(model.levers), list(model.constants),
+                        list(model.outcomes), function.__name__, n_scenarios, n_policies,
+                        lever_sampling.name, batch_size)).encode())
+    path = os.path.join(cache_dir, f"lake_{hasher.hexdigest()[:16]}.parquet")
+
+    if os.path.exists(path):
+        # the experiments and outcomes are stored side by side in one table
+        # parquet keeps neither the category dtype of these columns nor their
+        # categories, so restore them to match the frame of a fresh run
+        data = pd.read_parquet(path).astype({"scenario": "category", "policy": "category", "model": "category"})
+        outcomes = {outcome.name: data.pop(outcome.name).to_numpy() for outcome in model.outcomes}
+        return data, outcomes
+
+    with BatchEvaluator(model, function, batch_size=batch_size) as evaluator:
+        experiments, outcomes = evaluator.perform_experiments(n_scenarios, n_policies,
+                                                              lever_sampling=lever_sampling)
+
+    data = pd.concat([experiments, pd.DataFrame(outcomes)], axis=1)
+    # serialize first, so no empty cache_dir is left behind without a parquet
+    # engine
+    try:
+        buffer = data.to_parquet(compression="zstd")
+    except ImportError as e:
+        _logger.warning(f"results are not cached, writing parquet failed: {e}")
+        return experiments, outcomes
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(buffer)
+    return experiments, outcomes
+
+
 if __name__ == "__main__":
     ema_logging.log_to_stderr(ema_logging.INFO)
     model = Model('lakeproblem', function=lake_problem)
@@ -166,18 +218,7 @@ if __name__ == "__main__":
 
     # Set levers, one for each time step
 
-    model.levers = [RealParameter("c1", -2, 2),
-                    RealParameter("c2", -2, 2),
-                    RealParameter("r1", 0, 2),
-                    RealParameter("r2", 0, 2),
-                    RealParameter("w1", 0, 1)]
-
-
-    def process_p(values):
-        values = np.asarray(values)
-        values = np.mean(values, axis=0)
-        return np.max(values)
-
+    model.levers = [RealParameter(f"l{i}", 0, 0.1) for i in range(100)]
 
     # Specify outcomes
 
@@ -188,15 +229,30 @@ if __name__ == "__main__":
                       ]
 
     # why is this needed?
+    # with a seed the standard normal draws for the natural inflows are made
+    # once and shared by all scenarios and policies (common random numbers).
+    # Differences between experiments therefore reflect the uncertainties and
+    # levers only, not independent draws of the inflows. Samples are
+    # drawn in batches of 30 until the standard error of max_P and reliability
+    # is below 1% of their mean, nsamples is then the maximum number of samples
     model.constants = [
         Constant("alpha", 0.41),
         Constant("nsamples", 150),
+        Constant("seed", 1361),
+        Constant("target_sem", 0.01),
     ]
     # generate some random policies by sampling over levers
     n_scenarios = 1000
     n_policies = 4
-    with MultiprocessingEvaluator(lake_problem) as evaluator:
-        res = evaluator.perform_experiments(n_scenarios, n_policies, lever_sampling=Samplers.MC)
+
+    # the lake model runs in well under a millisecond, so hand the experiments
+    # to the workers in batches instead of one by one, one worker per physical
+    # core. On Windows, where the workers are spawned rather than forked, an
+    # IpyparallelEvaluator with a cluster started beforehand (ipcluster start)
+    # is the more reliable choice. Rerunning this cell, e.g. after a kernel
+    # restart, reads the results of an earlier identical run from disk
+    experiments, outcomes = load_or_perform_experiments(model, lake_problem_batch, n_scenarios, n_policies,
+                                                        lever_sampling=Samplers.MC, batch_size=128)
 #from ema_workbench import SequentialEvaluator
 
 #with SequentialEvaluator(model) as evaluator:
@@ -214,17 +270,27 @@ if __name__ == "__main__":
 # In[13]:
 
 
-import pandas as pd
-data = pd.DataFrame(res)
-print(data)
-
-# In[18]:
-
-
-import seaborn as sns
-import matplotlib.pyplot as plt
-sns.pairplot(data, vars=list(outcomes.keys()))
-plt.show()
+    import itertools
+
+    import matplotlib.pyplot as plt
+
+    # plot each pair of outcomes as a hexbin density straight from the arrays
+    # returned by the workbench, with histograms on the diagonal. Binning scales
+    # linearly with the number of experiments, unlike fitting a kde per outcome
+    # as sns.pairplot does
+    keys = list(outcomes.keys())
+    fig, axes = plt.subplots(len(keys), len(keys), figsize=(10, 10), sharex='col')
+    for i, j in itertools.product(range(len(keys)), repeat=2):
+        if i == j:
+            axes[i, j].hist(outcomes[keys[j]], bins=40)
+        else:
+            axes[i, j].hexbin(outcomes[keys[j]], outcomes[keys[i]], gridsize=40, mincnt=1)
+        if i == len(keys) - 1:
+            axes[i, j].set_xlabel(keys[j])
+        if j == 0:
+            axes[i, j].set_ylabel(keys[i])
+    fig.tight_layout()
+    plt.show()
 
 
 # 3. Explore the behavior of the system over 1000 scenarios for 4 randomly sampled candidate strategies.
@@ -0,0 +1,139 @@
+"""
+Evaluator that sends experiments to a multiprocessing pool in batches.
+
+For fast models like the lake problem, the overhead of sending each
+experiment to a worker on its own is larger than the time needed to run it.
+The BatchEvaluator groups the experiments generated by the workbench and
+hands each group to a function that evaluates the whole batch in one call.
+
+"""
+
+import itertools
+import multiprocessing
+import os
+
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from ema_workbench.em_framework.evaluators import BaseEvaluator, experiment_generator
+from ema_workbench.util import ema_logging
+
+_logger = ema_logging.get_module_logger(__name__)
+
+
+def _default_processes():
+    """One worker per physical core, leaving one core for the main process"""
+    cores = psutil.cpu_count(logical=False) if psutil is not None else None
+    if cores is None:
+        cores = os.cpu_count() or 1
+    return max(1, cores - 1)
+
+
+def _batch_kwargs(batch, variable_names, constants):
+    """Stack the scenario and policy of each experiment in the batch into
+    one array per parameter, passed under the variable names of the
+    parameter like the workbench does for a single experiment"""
+    kwargs = {}
+    for point in ("scenario", "policy"):
+        for key in getattr(batch[0], point):
+            values = np.array([getattr(experiment, point)[key] for experiment in batch])
+            for name in variable_names.get(key, [key]):
+                kwargs[name] = values
+    kwargs.update(constants)
+    return kwargs
+
+
+def _evaluate_batch(task):
+    """Evaluate a single batch in a worker"""
+    function, kwargs = task
+    return function(**kwargs)
+
+
+class BatchEvaluator(BaseEvaluator):
+    """evaluator for experiments using a multiprocessing pool, sending the
+    experiments to the workers in batches
+
+    Parameters
+    ----------
+    msis : AbstractModel instance
+    function : callable
+               called with an array for each uncertainty and lever, holding
+               one value per experiment in the batch, and with the model
+               constants as is. Returns one array for each outcome, in the
+               order of the model outcomes. A parameter with several
+               variable names passes the same array under each of them,
+               multivalue categorical parameters are not supported.
+    batch_size : int, optional
+    n_processes : int, optional
+                  defaults to the number of physical cores minus one, the
+                  model is memory bound and gains nothing from hyperthreads
+
+    """
+
+    def __init__(self, msis, function, batch_size=128, n_processes=None):
+        super().__init__(msis)
+
+        if len(self._msis) != 1:
+            raise ValueError("BatchEvaluator only supports a single model")
+
+        self.function = function
+        self.batch_size = batch_size
+        self.n_processes = n_processes if n_processes is not None else _default_processes()
+        self._pool = None
+
+    def initialize(self):
+        self._pool = multiprocessing.Pool(self.n_processes)
+        _logger.info(f"pool started with {self.n_processes} workers")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _logger.info("terminating pool")
+
+        if exc_type is not None:
+            self._pool.terminate()
+            return False
+
+        super().__exit__(exc_type, exc_value, traceback)
+
+    def finalize(self):
+        self._pool.close()
+        self._pool.join()
+
+    def evaluate_experiments(self, scenarios, policies, callback, combine="factorial"):
+        model = self._msis[0]
+        constants = {c.name: c.value for c in model.constants}
+        variable_names = {p.name: p.variable_name for p in itertools.chain(model.uncertainties, model.levers)}
+
+        ex_gen = experiment_generator(scenarios, self._msis, policies, combine=combine)
+        batches = list(iter(lambda: list(itertools.islice(ex_gen, self.batch_size)), []))
+        _logger.info(f"evaluating {len(batches)} batches of at most {self.batch_size} experiments")
+        if not batches:
+            return
+
+        # the experiments stay in this process, only the parameter arrays
+        # go to the workers
+        tasks = ((self.function, _batch_kwargs(batch, variable_names, constants)) for batch in batches)
+
+        # a few tasks per worker at a time, enough to keep them busy without
+        # paying the inter process communication for every batch
+        chunksize = max(1, len(batches) // (self.n_processes * 4))
+
+        # the first batch runs on its own. A function that is compiled on
+        # first use and cached on disk, like the numba kernels of the lake
+        # model, is then compiled by a single worker, and the other workers
+        # load it from the cache instead of all compiling it at the same time
+        results = itertools.chain(
+            [self._pool.apply(_evaluate_batch, (next(tasks),))], self._pool.imap(_evaluate_batch, tasks, chunksize)
+        )
+
+        for batch, outputs in zip(batches, results):
+            for i, experiment in enumerate(batch):
+                outcomes = {
+                    outcome.name: outcome.process([output[i]])
+                    for outcome, output in zip(model.outcomes, outputs)
+                }
+                callback(experiment, outcomes)
@@ -1,6 +1,228 @@
-import math
+import functools
 import numpy as np
-from scipy.optimize import brentq
+from numba import njit
+
+# The kernels are compiled on first use and cached on disk (cache=True), so
+# only the first process that runs them compiles, later worker processes load
+# the cached code.
+#
+# They are not specialized on the number of time steps or samples. The time
+# loop is a recurrence no compiler can vectorize, and the loop over the
+# samples is bound by X**q, which LLVM only vectorizes with Intel's SVML
+# installed. Dispatching on numba.literally made each call slower, and a
+# sample loop with a trip count fixed at compile time ran no faster.
+
+
+# With a target standard error, the samples are simulated in batches of this
+# size until the outcomes are precise enough
+SAMPLE_BATCH = 30
+
+
+@njit(cache=True)
+def _relative_sem(total, total_sq, n):
+    """Standard error of the mean relative to the mean, from the sum and the
+    sum of squares of n values"""
+    mean = total / n
+    var = max(total_sq / n - mean * mean, 0.0) * n / (n - 1)
+    if var == 0:
+        return 0.0
+    if mean == 0:
+        return np.inf
+    return np.sqrt(var / n) / abs(mean)
+
+
+# The kernel runs single threaded. The evaluators already start one worker
+# process per core, so threads within a worker would only compete for the
+# same cores.
+@njit(cache=True, fastmath=True)
+def _simulate(X0, decisions, b, q, delta, alpha, Pcrit, natural_inflows, sample_batch, target_sem):
+    """Run the lake model for each experiment, returning the four outcomes
+    and the number of samples used.
+
+    natural_inflows has shape (nexperiments, nvars, nsamples) and decisions
+    (nexperiments, nvars), b, q, delta and Pcrit hold one value per
+    experiment. Samples are run sample_batch at a time, stopping once the
+    standard errors of max_P and reliability are below target_sem relative
+    to their means. A target_sem of 0 uses all samples.
+    """
+    nexperiments, nvars, nsamples = natural_inflows.shape
+    max_P = np.empty(nexperiments)
+    utility = np.empty(nexperiments)
+    inertia = np.empty(nexperiments)
+    reliability = np.empty(nexperiments)
+    samples_used = np.empty(nexperiments, dtype=np.int64)
+    one = np.float32(1)
+
+    for e in range(nexperiments):
+        total_P = np.zeros(nvars)
+        total_P_sq = np.zeros(nvars)
+        total_reliability = 0.0
+        total_reliability_sq = 0.0
+        discounted_decisions = 0.0
+        discount = 1.0
+        large_changes = 0
+
+        n = 0
+        while n < nsamples:
+            m = min(sample_batch, nsamples - n)
+
+            # Start from a clean lake at t=0
+            X = np.full(m, X0, dtype=np.float32)
+            below_Pcrit = np.full(m, 1 if X0 < Pcrit[e] else 0)
+            total_P[0] += m * X0
+            total_P_sq[0] += m * X0 * X0
+
+            for t in range(1, nvars):
+                decision = decisions[e, t - 1]
+                if n == 0:
+                    discounted_decisions += decision * discount
+                    discount *= delta[e]
+                    large_changes += abs(decisions[e, t] - decision) > 0.02
+
+                release = np.float32(decision)
+                batch_P = 0.0
+                batch_P_sq = 0.0
+                for j in range(m):
+                    # X**q is needed twice, so compute it only once
+                    Xq = X[j] ** q[e]
+                    X[j] = (one - b[e]) * X[j] + Xq / (one + Xq) + release + natural_inflows[e, t - 1, n + j]
+                    batch_P += X[j]
+                    batch_P_sq += X[j] * X[j]
+                    below_Pcrit[j] += X[j] < Pcrit[e]
+                total_P[t] += batch_P
+                total_P_sq[t] += batch_P_sq
+
+            for j in range(m):
+                sample_reliability = below_Pcrit[j] / nvars
+                total_reliability += sample_reliability
+                total_reliability_sq += sample_reliability * sample_reliability
+            n += m
+
+            if target_sem > 0 and n < nsamples:
+                peak = np.argmax(total_P)
+                if (_relative_sem(total_P[peak], total_P_sq[peak], n) < target_sem
+                        and _relative_sem(total_reliability, total_reliability_sq, n) < target_sem):
+                    break
+
+        # The decision of the last time step only counts towards the utility
+        discounted_decisions += decisions[e, nvars - 1] * discount
+
+        max_P[e] = np.max(total_P) / n
+        utility[e] = alpha * discounted_decisions
+        inertia[e] = large_changes / (nvars - 1)
+        reliability[e] = total_reliability / n
+        samples_used[e] = n
+
+    return max_P, utility, inertia, reliability, samples_used
+
+
+@njit(cache=True)
+def _critical_level(b, q):
+    """Find the critical pollution level, the root of x**q / (1 + x**q) - b*x
+    in [0.01, 1.5], for each experiment.
+
+    Uses Newton steps with the analytic derivative. The root stays bracketed,
+    a step that would leave the bracket is replaced by bisection.
+    """
+    Pcrit = np.empty(b.shape[0])
+
+    for e in range(b.shape[0]):
+        lo, hi = 0.01, 1.5
+        f_lo = lo ** q[e] / (1 + lo ** q[e]) - b[e] * lo
+        f_hi = hi ** q[e] / (1 + hi ** q[e]) - b[e] * hi
+        if f_lo * f_hi > 0:
+            raise ValueError("no critical pollution level in [0.01, 1.5]")
+
+        x = 0.5 * (lo + hi)
+        for _ in range(100):
+            xq = x ** q[e]
+            f = xq / (1 + xq) - b[e] * x
+            if f == 0:
+                break
+
+            if (f < 0) == (f_lo < 0):
+                lo = x
+            else:
+                hi = x
+
+            df = q[e] * xq / x / (1 + xq) ** 2 - b[e]
+            step = x - f / df if df != 0 else x
+            if not lo < step < hi:
+                step = 0.5 * (lo + hi)
+
+            converged = abs(step - x) < 2e-12
+            x = step
+            if converged:
+                break
+
+        Pcrit[e] = x
+
+    return Pcrit
+
+
+@functools.lru_cache(maxsize=8)
+def _standard_normal(nsamples, nvars, seed):
+    # One PCG64 draw per seed. Every scenario and policy reuses this same
+    # matrix, i.e. common random numbers across all experiments
+    noise = np.random.default_rng(seed).standard_normal((nvars, nsamples), dtype=np.float32)
+    noise.flags.writeable = False
+    return noise
+
+
+def draw_noise(mean, stdev, nsamples, nvars, seed=None):
+    """Draw the natural inflows for each scenario in mean and stdev.
+
+    The inflows are lognormal, single precision, and have shape
+    (nscenarios, nvars, nsamples), so the samples of a time step are
+    contiguous.
+    Without a seed, new inflows are drawn on each call. With a seed, the
+    underlying standard normal draws are made once and cached, and every
+    scenario and policy transforms the same draws: these are common random
+    numbers. The inflows of two scenarios then differ only through mean
+    and stdev, they are not independent samples of the stochastic inflow.
+    """
+    mean = np.asarray(mean, dtype=np.float64)[:, np.newaxis, np.newaxis]
+    stdev = np.asarray(stdev, dtype=np.float64)[:, np.newaxis, np.newaxis]
+    mu = np.log(mean ** 2 / np.sqrt(stdev ** 2 + mean ** 2))
+    sigma = np.sqrt(np.log(1.0 + stdev ** 2 / mean ** 2))
+
+    if seed is None:
+        noise = np.random.default_rng().standard_normal((mean.shape[0], nvars, nsamples), dtype=np.float32)
+    else:
+        noise = _standard_normal(nsamples, nvars, seed)
+
+    # Transform the draws in place, only the inflows themselves are allocated
+    inflows = sigma.astype(np.float32) * noise
+    inflows += mu.astype(np.float32)
+    return np.exp(inflows, out=inflows)
+
+
+def _lake_problem(b, q, mean, stdev, delta, alpha, nsamples, decisions, seed, target_sem):
+    # All uncertainties are arrays with one value per experiment, the
+    # decisions have shape (nexperiments, nvars)
+    nexperiments, nvars = decisions.shape
+
+    # Calculate the critical pollution level (Pcrit)
+    Pcrit = _critical_level(b, q)
+
+    # Generate natural inflows using lognormal distribution
+    natural_inflows = draw_noise(mean, stdev, nsamples, nvars, seed)
+
+    # Loop through time to compute the pollution levels and all outcomes at once: the
+    # maximum of the average daily pollution (max_P), the utility by discounting the
+    # decisions using the discount factor (delta), the inertia (the fraction of time
+    # steps with changes larger than 0.02) and the reliability (probability of the
+    # pollution level being below Pcrit). With a target standard error, nsamples is the
+    # maximum number of samples
+    if target_sem is None:
+        sample_batch, target_sem = nsamples, 0.0
+    else:
+        sample_batch = SAMPLE_BATCH
+    max_P, utility, inertia, reliability, _ = _simulate(0.0, decisions, b.astype(np.float32), q.astype(np.float32),
+                                                        delta, float(alpha), Pcrit, natural_inflows, sample_batch,
+                                                        float(target_sem))
+
+    return max_P, utility, inertia, reliability
 
 
 def lake_problem(
@@ -12,6 +234,8 @@ def lake_problem(
         alpha=0.4,      # Utility from pollution
         nsamples=100,   # Number of Monte Carlo samples to draw
         steps=100,      # Number of time steps
+        seed=None,      # Seed for the natural inflows, None draws new inflows on each call
+        target_sem=None,  # Relative standard error at which to stop sampling, None uses all nsamples
         l0=0, l1=0, l2=0, l3=0, l4=0, l5=0, l6=0, l7=0, l8=0, l9=0,
         l10=0, l11=0, l12=0, l13=0, l14=0, l15=0, l16=0, l17=0, l18=0, l19=0,
         l20=0, l21=0, l22=0, l23=0, l24=0, l25=0, l26=0, l27=0, l28=0, l29=0,
@@ -31,40 +255,33 @@ def lake_problem(
                           l62, l63, l64, l65, l66, l67, l68, l69, l70, l71, l72, l73,
                           l74, l75, l76, l77, l78, l79, l80, l81, l82, l83, l84, l85,
                           l86, l87, l88, l89, l90, l91, l92, l93, l94, l95, l96, l97,
-                          l98, l99])
-    nvars = len(decisions)
-
-    # Calculate the critical pollution level (Pcrit)
-    Pcrit = brentq(lambda x: x ** q / (1 + x ** q) - b * x, 0.01, 1.5)
-
-    # Generate natural inflows using lognormal distribution
-    natural_inflows = np.random.lognormal(
-        mean=math.log(mean ** 2 / math.sqrt(stdev ** 2 + mean ** 2)),
-        sigma=math.sqrt(math.log(1.0 + stdev ** 2 / mean ** 2)),
-        size=(nsamples, nvars)
-    )
+                          l98, l99], dtype=np.float64)
 
-    # Initialize the pollution level matrix X
-    X = np.zeros((nsamples, nvars))
+    # Run the model as a batch holding this single experiment
+    outcomes = _lake_problem(np.array([b], dtype=np.float64), np.array([q], dtype=np.float64),
+                             np.array([mean], dtype=np.float64), np.array([stdev], dtype=np.float64),
+                             np.array([delta], dtype=np.float64), alpha, nsamples, decisions[np.newaxis, :], seed,
+                             target_sem)
+    max_P, utility, inertia, reliability = (outcome[0] for outcome in outcomes)
 
-    # Loop through time to compute the pollution levels
-    for t in range(1, nvars):
-        X[:, t] = (1 - b) * X[:, t - 1] + (X[:, t - 1] ** q / (1 + X[:, t - 1] ** q)) + decisions[
-            t - 1] + natural_inflows[:, t - 1]
-
-    # Calculate the average daily pollution for each time step
-    average_daily_P = np.mean(X, axis=0)
+    return max_P, utility, inertia, reliability
 
-    # Calculate the reliability (probability of the pollution level being below Pcrit)
-    reliability = np.sum(X < Pcrit) / float(nsamples * nvars)
 
-    # Calculate the maximum pollution level (max_P)
-    max_P = np.max(average_daily_P)
+def lake_problem_batch(b, q, mean, stdev, delta, alpha=0.4, nsamples=100, steps=100, seed=None, target_sem=None,
+                       **kwargs):
+    """Run the lake problem for a batch of experiments at once.
 
-    # Calculate the utility by discounting the decisions using the discount factor (delta)
-    utility = np.sum(alpha * decisions * np.power(delta, np.arange(nvars)))
+    Takes the same arguments as lake_problem, but each uncertainty and
+    lever (l0 up to l99) is an array with one value per experiment. Levers
+    that are not given are 0. The four outcomes are returned as arrays.
+    """
+    levers = [f"l{i}" for i in range(100)]
+    unknown = sorted(set(kwargs) - set(levers))
+    if unknown:
+        raise TypeError(f"lake_problem_batch() got unexpected keyword arguments {', '.join(unknown)}")
 
-    # Calculate the inertia (the fraction of time steps with changes larger than 0.02)
-    inertia = np.sum(np.abs(np.diff(decisions)) > 0.02) / float(nvars - 1)
+    b, q, mean, stdev, delta = (np.asarray(value, dtype=np.float64) for value in (b, q, mean, stdev, delta))
+    decisions = np.column_stack([np.broadcast_to(np.asarray(kwargs.get(lever, 0), dtype=np.float64), b.shape)
+                                 for lever in levers])
 
-    return max_P, utility, inertia, reliability
+    return _lake_problem(b, q, mean, stdev, delta, alpha, nsamples, decisions, seed, target_sem)
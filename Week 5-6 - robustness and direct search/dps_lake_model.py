@@ -9,8 +9,9 @@ def get_antropogenic_release(xt, c1, c2, r1, r2, w1):
 
     Parameters
     ----------
-    xt : float
-         polution in lake at time t
+    xt : float or ndarray
+         polution in lake at time t, an array gives the release for each
+         value in it
     c1 : float
          center rbf 1
     c2 : float
@@ -24,15 +25,14 @@ def get_antropogenic_release(xt, c1, c2, r1, r2, w1):
 
     Returns
     -------
-    float
+    float or ndarray
 
     note:: w2 = 1 - w1
 
     '''
 
-    rule = w1*(abs(xt-c1)/r1)**3+(1-w1)*(abs(xt-c2)/r2)**3
-    at1 = max(rule, 0.01)
-    at = min(at1, 0.1)
+    rule = w1*(np.abs(xt-c1)/r1)**3+(1-w1)*(np.abs(xt-c2)/r2)**3
+    at = np.clip(rule, 0.01, 0.1)
 
     return at
 
@@ -77,38 +77,33 @@ def lake_model(b=0.42, q=2.0, mean=0.02,
     np.random.seed(seed)
     Pcrit = brentq(lambda x: x**q/(1+x**q) - b*x, 0.01, 1.5)
 
-    X = np.zeros((myears,))
-    average_daily_P = np.zeros((myears,))
-    reliability = 0.0
-    inertia = 0
-    utility = 0
-
-    for _ in range(nsamples):
-        X[0] = 0.0
-        decision = 0.1
-
-        decisions = np.zeros(myears,)
-        decisions[0] = decision
-
-        natural_inflows = np.random.lognormal(
-            math.log(mean**2 / math.sqrt(stdev**2 + mean**2)),
-            math.sqrt(math.log(1.0 + stdev**2 / mean**2)),
-            size=myears)
-
-        for t in range(1, myears):
-
-            # here we use the decision rule
-            decision = get_antropogenic_release(X[t-1], c1, c2, r1, r2, w1)
-            decisions[t] = decision
-
-            X[t] = (1-b)*X[t-1] + X[t-1]**q/(1+X[t-1]**q) + decision +\
-                natural_inflows[t-1]
-            average_daily_P[t] += X[t]/nsamples
-
-        reliability += np.sum(X < Pcrit)/(nsamples*myears)
-        inertia += np.sum(np.absolute(np.diff(decisions)
-                                      < 0.02)) / (nsamples*myears)
-        utility += np.sum(alpha*decisions*np.power(delta,
-                                                   np.arange(myears))) / nsamples
+    # all samples are simulated at once, so the decision rule is evaluated
+    # for every sample in a single call at each time step
+    X = np.zeros((nsamples, myears))
+    decisions = np.zeros((nsamples, myears))
+    decisions[:, 0] = 0.1
+
+    natural_inflows = np.random.lognormal(
+        math.log(mean**2 / math.sqrt(stdev**2 + mean**2)),
+        math.sqrt(math.log(1.0 + stdev**2 / mean**2)),
+        size=(nsamples, myears))
+
+    for t in range(1, myears):
+
+        # here we use the decision rule
+        decisions[:, t] = get_antropogenic_release(X[:, t-1], c1, c2, r1,
+                                                   r2, w1)
+
+        X[:, t] = (1-b)*X[:, t-1] + X[:, t-1]**q/(1+X[:, t-1]**q) +\
+            decisions[:, t] + natural_inflows[:, t-1]
+
+    average_daily_P = np.mean(X, axis=0)
+    reliability = np.sum(X < Pcrit)/(nsamples*myears)
+    inertia = np.sum(np.absolute(np.diff(decisions, axis=1)
+                                 < 0.02)) / (nsamples*myears)
+    # discount the release averaged over the samples with a single dot
+    # product instead of discounting every sample separately
+    discount = np.power(delta, np.arange(myears, dtype=np.float64))
+    utility = alpha*np.dot(np.mean(decisions, axis=0), discount)
     max_P = np.max(average_daily_P)
-    return max_P, utility, inertia, reliability
\ No newline at end of file
+    return max_P, utility, inertia, reliability